@@ -1,19 +1,115 @@
-import json
+import asyncio
+import os
+import httpx
+import ijson
+import msgspec
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import re
+import socket
+import sqlite3
+import tempfile
+import threading
 import time
-from flask import Flask, request, render_template_string, jsonify
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from array import array
+from collections import Counter
+from contextlib import closing
+from flask import Flask, Response, request, jsonify, stream_with_context
+from flask.json.provider import DefaultJSONProvider
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
 import signal
-from tqdm import tqdm
+from werkzeug.exceptions import RequestEntityTooLarge
+
+# JSON provider that serializes jsonify() responses with msgspec's C encoder
+class MsgspecJSONProvider(DefaultJSONProvider):
+    def dumps(self, obj, **kwargs):
+        order = "sorted" if kwargs.get("sort_keys", self.sort_keys) else None
+        # Types msgspec cannot encode (e.g. Markup) fall back to Flask's default hook
+        encoded = msgspec.json.encode(obj, enc_hook=self.default, order=order)
+        if kwargs.get("indent"):
+            encoded = msgspec.json.format(encoded, indent=kwargs["indent"])
+        return encoded.decode()
+
+    # json.loads options (object_hook etc.) have no msgspec equivalent and are ignored
+    def loads(self, s, **kwargs):
+        return msgspec.json.decode(s)
 
 # Flask app setup
 app = Flask(__name__)
+app.json = MsgspecJSONProvider(app)
+# Reject oversized uploads before they are read into memory
+app.config['MAX_CONTENT_LENGTH'] = int(os.environ.get("YTH_MAX_UPLOAD", str(256 << 20)))
 
 # Regular expression to identify URLs
 URL_REGEX = re.compile(
     r"https?://(?:www\.)?[a-zA-Z0-9\-_]+\.[a-zA-Z]{2,}(?:/[^ \n]*)?"
 )
+# Literal prefixes checked before running URL_REGEX on a string
+URL_PREFIXES = ("http://", "https://")
+
+# Number of worker threads used for the IO-bound URL requests
+MAX_THREADS = int(os.environ.get("YTH_MAX_THREADS", "32"))
+
+# Read size used when draining response bodies in accurate mode
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+# Maximum number of in-flight HEAD requests on the async path
+MAX_IN_FLIGHT = int(os.environ.get("YTH_MAX_IN_FLIGHT", "200"))
+
+# Connections kept by the HEAD client; HTTP/2 multiplexes the in-flight requests over them
+MAX_CONNECTIONS = int(os.environ.get("YTH_MAX_CONNECTIONS", "20"))
+
+# Seconds an idle HEAD connection is kept open for reuse by later uploads
+KEEPALIVE_EXPIRY = int(os.environ.get("YTH_KEEPALIVE_EXPIRY", "300"))
+
+# Seconds a resolved hostname is reused before looking it up again
+DNS_CACHE_TTL = int(os.environ.get("YTH_DNS_CACHE_TTL", "300"))
+
+# On-disk cache of HEAD results so re-uploads skip the network
+HEAD_CACHE_PATH = os.environ.get(
+    "YTH_HEAD_CACHE", os.path.join(tempfile.gettempdir(), "yt_head_cache.sqlite")
+)
+HEAD_CACHE_TTL = int(os.environ.get("YTH_HEAD_CACHE_TTL", "86400"))
+
+# Worker processes that decode uploads off the request thread (0 decodes inline)
+PARSE_WORKERS = int(os.environ.get("YTH_PARSE_WORKERS", "0"))
+PARSE_POOL = ProcessPoolExecutor(PARSE_WORKERS) if PARSE_WORKERS else None
+PARSE_POOL_LOCK = threading.Lock()
+
+# Uploads larger than this are scanned incrementally instead of fully decoded
+STREAM_THRESHOLD = int(os.environ.get("YTH_STREAM_THRESHOLD", str(16 * 1024 * 1024)))
+
+# Shared session so pooled keep-alive connections survive across uploads
+SESSION = requests.Session()
+adapter = HTTPAdapter(
+    pool_connections=32,
+    pool_maxsize=64,
+    max_retries=Retry(total=2, backoff_factor=0.2),
+)
+SESSION.mount("https://", adapter)
+SESSION.mount("http://", adapter)
+DEFAULT_HEADERS = {"User-Agent": "YTotalHours/1.0"}
+# Connection is an HTTP/1.1-only header, so it is not part of DEFAULT_HEADERS
+SESSION.headers.update({**DEFAULT_HEADERS, "Connection": "keep-alive"})
+
+# Resolved addresses shared across uploads, keyed by the getaddrinfo arguments
+DNS_CACHE = {}
+system_getaddrinfo = socket.getaddrinfo
+
+# Resolve through DNS_CACHE; installed process-wide so every HTTP client
+# (the requests Session and the async HEAD client) shares one cache
+def cached_getaddrinfo(*args, **kwargs):
+    key = (args, tuple(sorted(kwargs.items())))
+    cached = DNS_CACHE.get(key)
+    if cached and cached[0] > time.monotonic():
+        return cached[1]
+    addresses = system_getaddrinfo(*args, **kwargs)
+    DNS_CACHE[key] = (time.monotonic() + DNS_CACHE_TTL, addresses)
+    return addresses
+
+socket.getaddrinfo = cached_getaddrinfo
 
 # Graceful exit on interrupt
 def handle_interrupt(signal_received, frame):
@@ -22,71 +118,230 @@ def handle_interrupt(signal_received, frame):
 
 signal.signal(signal.SIGINT, handle_interrupt)
 
-# Function to recursively find all URLs in a JSON object
+# Function to find all URLs in a JSON object (iterative walk, document order)
 def find_urls(data):
     urls = []
-    if isinstance(data, dict):
-        for key, value in data.items():
-            urls.extend(find_urls(value))
-    elif isinstance(data, list):
-        for item in data:
-            urls.extend(find_urls(item))
-    elif isinstance(data, str) and URL_REGEX.match(data):
-        urls.append(data)
+    match = URL_REGEX.match
+    stack = [data]
+    while stack:
+        item = stack.pop()
+        if isinstance(item, dict):
+            stack.extend(reversed(list(item.values())))
+        elif isinstance(item, list):
+            stack.extend(reversed(item))
+        elif isinstance(item, str) and item.startswith(URL_PREFIXES) and match(item):
+            urls.append(item)
     return urls
 
-# Function to calculate size/time using HEAD requests (faster, less accurate)
-def head_request(url, session):
-    try:
-        start_time = time.time()
-        with session.head(url, timeout=10) as response:
+# Function to decode an uploaded JSON document (strict: NaN/Infinity are rejected)
+def load_json(raw):
+    return msgspec.json.decode(raw)
+
+# Function to decode an upload and return its URLs (None if it is not a list)
+def extract_urls(raw):
+    data = load_json(raw)
+    return find_urls(data) if isinstance(data, list) else None
+
+# Function to decode an upload in PARSE_POOL when configured, inline otherwise
+def parse_upload(raw):
+    global PARSE_POOL
+    pool = PARSE_POOL
+    if pool is not None:
+        try:
+            # Only the URL list is sent back, not the decoded document
+            return pool.submit(extract_urls, raw).result()
+        except BrokenProcessPool:
+            # A worker died (e.g. OOM-killed); replace the pool and decode this upload inline
+            app.logger.warning("Parse pool is broken; starting a new one")
+            with PARSE_POOL_LOCK:
+                if PARSE_POOL is pool:
+                    PARSE_POOL = ProcessPoolExecutor(PARSE_WORKERS)
+            pool.shutdown(wait=False)
+    return extract_urls(raw)
+
+# Function to pull URLs out of a JSON upload without building the whole document
+def stream_urls(file):
+    events = ijson.parse(file)
+    _, event, _ = next(events, (None, None, None))
+    if event != "start_array":
+        return None
+    urls = []
+    for _, event, value in events:
+        if event == "string" and value.startswith(URL_PREFIXES) and URL_REGEX.match(value):
+            urls.append(value)
+    return urls
+
+# Function to calculate size using HEAD requests (faster, less accurate)
+# Nothing is downloaded, so no time is reported; a size of None marks a failure
+async def head_request(url, client, semaphore):
+    async with semaphore:
+        try:
+            response = await client.head(url)
+            # Follow at most one redirect rather than chasing the whole chain
+            if response.next_request is not None:
+                response = await client.send(response.next_request)
+            # Error statuses (e.g. 429) and a second redirect are failures, not sizes worth caching
+            if not response.is_success:
+                return url, None, 0.0
             total_bytes = int(response.headers.get("Content-Length", 0))
-        elapsed_time = time.time() - start_time
-        return url, total_bytes, elapsed_time
-    except requests.RequestException:
-        return url, 0, 0
+            # Sizes must fit a signed 64-bit SQLite INTEGER
+            if not 0 <= total_bytes < 2 ** 63:
+                return url, None, 0.0
+            return url, total_bytes, 0.0
+        except (httpx.HTTPError, httpx.InvalidURL, ValueError):
+            # Unreachable hosts, unparseable URLs and bad Content-Length all count as failures
+            return url, None, 0.0
+
+# Run every HEAD request concurrently over a shared HTTP/2 client
+async def head_all(urls, client, max_in_flight=MAX_IN_FLIGHT):
+    semaphore = asyncio.Semaphore(max_in_flight)
+    return await asyncio.gather(*(head_request(url, client, semaphore) for url in urls))
+
+# Build the long-lived HEAD client; runs on HEAD_LOOP so its pool is bound there
+async def make_head_client():
+    limits = httpx.Limits(
+        max_connections=MAX_CONNECTIONS,
+        max_keepalive_connections=MAX_CONNECTIONS,
+        keepalive_expiry=KEEPALIVE_EXPIRY,
+    )
+    # 2s to connect, 3s per read; waiting for a free connection is not capped
+    timeout = httpx.Timeout(3, connect=2, pool=None)
+    return httpx.AsyncClient(http2=True, limits=limits, timeout=timeout, headers=DEFAULT_HEADERS)
+
+# Event loop and client shared by every upload, started on first use (after any fork)
+HEAD_LOOP = None
+HEAD_CLIENT = None
+HEAD_LOCK = threading.Lock()
+
+# HEAD every URL on the shared loop so connections outlive a single upload
+def run_head_all(urls):
+    global HEAD_LOOP, HEAD_CLIENT
+    with HEAD_LOCK:
+        if HEAD_LOOP is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name="head-loop", daemon=True).start()
+            HEAD_CLIENT = asyncio.run_coroutine_threadsafe(make_head_client(), loop).result()
+            HEAD_LOOP = loop
+    return asyncio.run_coroutine_threadsafe(head_all(urls, HEAD_CLIENT), HEAD_LOOP).result()
+
+# Open the HEAD result cache, creating its table on first use
+def open_head_cache():
+    conn = sqlite3.connect(HEAD_CACHE_PATH, timeout=10)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS head_cache "
+        "(url TEXT PRIMARY KEY, size INTEGER, elapsed REAL, fetched_at REAL)"
+    )
+    return conn
+
+# HEAD every URL, answering from the on-disk cache where it is still fresh
+def head_all_cached(urls, batch_size=500):
+    with closing(open_head_cache()) as conn:
+        cutoff = time.time() - HEAD_CACHE_TTL
+        cached = {}
+        for i in range(0, len(urls), batch_size):
+            batch = urls[i:i + batch_size]
+            rows = conn.execute(
+                "SELECT url, size, elapsed FROM head_cache WHERE fetched_at > ? "
+                f"AND url IN ({','.join('?' * len(batch))})",
+                [cutoff, *batch],
+            )
+            for url, size, elapsed in rows:
+                cached[url] = (url, size, elapsed)
+
+        misses = [url for url in urls if url not in cached]
+        fetched = run_head_all(misses) if misses else []
+
+        # Failed requests are not cached and count as zero bytes
+        now = time.time()
+        with conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO head_cache VALUES (?, ?, ?, ?)",
+                [(url, size, elapsed, now) for url, size, elapsed in fetched if size is not None],
+            )
+        for url, size, elapsed in fetched:
+            cached[url] = (url, size or 0, elapsed)
+        # Rows come back in upload order regardless of which ones were cache hits
+        return [cached[url] for url in urls]
 
 # Function to download and measure size/time (slower, more accurate)
 def download_request(url, session):
     try:
-        start_time = time.time()
-        with session.get(url, stream=True, timeout=10) as response:
-            total_bytes = sum(len(chunk) for chunk in response.iter_content(chunk_size=8192))
-        elapsed_time = time.time() - start_time
+        start_time = time.monotonic()
+        # identity encoding means the body arrives as-is, with nothing to decompress
+        headers = {"Accept-Encoding": "identity"}
+        with session.get(url, stream=True, timeout=10, headers=headers) as response:
+            chunks = response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE)
+            total_bytes = sum(len(chunk) for chunk in chunks)
+        elapsed_time = time.monotonic() - start_time
         return url, total_bytes, elapsed_time
     except requests.RequestException:
         return url, 0, 0
 
 # Function to format seconds into minutes and seconds
+@app.template_filter("duration")
 def format_time(total_seconds):
     minutes = total_seconds // 60
     seconds = total_seconds % 60
     return f"{minutes} minutes and {seconds} seconds"
 
+# Function to iterate the per-video columns as (url, count, size, elapsed) rows
+@app.template_global()
+def video_rows(video_details):
+    return zip(
+        video_details['urls'],
+        video_details['counts'],
+        video_details['sizes'],
+        video_details['elapsed'],
+    )
+
+# Function to format a byte count in kilobytes
+@app.template_filter("kb")
+def format_kb(size):
+    return f"{size / 1024:.2f} KB"
+
+# Download every URL using a thread pool over the shared session
+def download_all(urls, max_threads=MAX_THREADS, log_every=1000):
+    results = []
+    with ThreadPoolExecutor(max_threads) as executor:
+        future_to_url = {executor.submit(download_request, url, SESSION): url for url in urls}
+        for i, future in enumerate(as_completed(future_to_url), 1):
+            results.append(future.result())
+            if i % log_every == 0:
+                app.logger.info("Processed %d/%d URLs", i, len(urls))
+    return results
+
 # Process URLs and calculate sizes/time
-def process_urls(urls, max_threads=10, accurate=False):
-    # Initialize session for connection pooling
-    session = requests.Session()
-    function_to_use = download_request if accurate else head_request
+def process_urls(urls, max_threads=MAX_THREADS, accurate=False):
+    # Request each distinct URL once; repeats are weighted by their count
+    counts = Counter(urls)
+    unique_urls = list(counts)
+    if len(unique_urls) < len(urls):
+        app.logger.info("Skipped %d duplicate URLs", len(urls) - len(unique_urls))
+
+    # Downloads stay on threads; HEAD requests fan out on an event loop
+    if accurate:
+        results = download_all(unique_urls, max_threads)
+    else:
+        results = head_all_cached(unique_urls)
 
-    # Process URLs with threading
     total_size = 0
     total_time = 0
-    video_details = []
+    # Per-video results kept as parallel columns rather than one dict per row
+    video_details = {
+        'urls': [],
+        'counts': array('Q'),
+        'sizes': array('Q'),  # Size in bytes
+        'elapsed': array('d'),  # Time in seconds
+    }
 
-    with ThreadPoolExecutor(max_threads) as executor:
-        future_to_url = {executor.submit(function_to_use, url, session): url for url in urls}
-        for future in tqdm(as_completed(future_to_url), total=len(urls), desc="Processing URLs"):
-            url, size, elapsed = future.result()
-            total_size += size
-            total_time += elapsed
-            video_details.append({
-                'url': url,
-                'size': size / 1024,  # Size in KB
-                'time': elapsed,  # Time in seconds
-                'formatted_time': format_time(elapsed),
-                'formatted_size': f"{size / 1024:.2f} KB"
-            })
+    for url, size, elapsed in results:
+        count = counts[url]
+        total_size += size * count
+        total_time += elapsed * count
+        video_details['urls'].append(url)
+        video_details['counts'].append(count)
+        video_details['sizes'].append(size)
+        video_details['elapsed'].append(elapsed)
 
     # Calculate total time in minutes and seconds
     total_minutes = total_time // 60
@@ -94,6 +349,7 @@ def process_urls(urls, max_threads=10, accurate=False):
     total_time_str = f"{total_minutes}m {total_remaining_seconds}s"
 
     return {
+        "total_urls": len(urls),
         "total_size": total_size / (1024 * 1024),  # Size in MB
         "total_time": total_time_str,
         "video_details": video_details
@@ -119,10 +375,38 @@ UPLOAD_FORM_HTML = """
 </html>
 """
 
+# HTML for the processing results page
+RESULTS_HTML = """
+<h1>Processing Results</h1>
+<p><strong>Total URLs processed:</strong> {{ results['total_urls'] }}</p>
+<p><strong>Total size:</strong> {{ results['total_size'] }} MB</p>
+<p><strong>Total time:</strong> {{ results['total_time'] }}</p>
+<ul>
+    {% for url, count, size, elapsed in video_rows(results['video_details']) %}
+    <li>
+        URL: {{ url }}<br>
+        Count: {{ count }}<br>
+        Size: {{ size|kb }}<br>
+        Time: {{ elapsed|duration }}
+    </li>
+    {% endfor %}
+</ul>
+<a href="/">Upload another file</a>
+"""
+
+# Templates are compiled once at import instead of on every request
+UPLOAD_FORM_TEMPLATE = app.jinja_env.from_string(UPLOAD_FORM_HTML)
+RESULTS_TEMPLATE = app.jinja_env.from_string(RESULTS_HTML)
+
+# Report uploads over MAX_CONTENT_LENGTH the same way as other upload errors
+@app.errorhandler(RequestEntityTooLarge)
+def upload_too_large(error):
+    return jsonify({"error": "File too large."}), 413
+
 # Main route to display the upload form
 @app.route('/', methods=['GET'])
 def index():
-    return render_template_string(UPLOAD_FORM_HTML)
+    return UPLOAD_FORM_TEMPLATE.render()
 
 # Handle uploaded JSON file and process URLs
 @app.route('/upload', methods=['POST'])
@@ -136,11 +420,13 @@ def upload():
         return jsonify({"error": "No selected file"}), 400
     
     try:
-        data = json.load(file)  # Load JSON data from the uploaded file
-        if not isinstance(data, list):
+        if (request.content_length or 0) > STREAM_THRESHOLD:
+            urls = stream_urls(file)  # Scan large uploads incrementally
+        else:
+            urls = parse_upload(file.read())
+        if urls is None:
             return jsonify({"error": "Invalid JSON structure. Should be a list of URLs."}), 400
         
-        urls = find_urls(data)
         if not urls:
             return jsonify({"error": "No valid URLs found in the JSON file."}), 400
         
@@ -150,27 +436,15 @@ def upload():
         if mode == "2":
             accurate = True
         
-        results = process_urls(urls, max_threads=10, accurate=accurate)
-
-        # Display total results on the webpage
-        return render_template_string("""
-        <h1>Processing Results</h1>
-        <p><strong>Total URLs processed:</strong> {{ len(results['video_details']) }}</p>
-        <p><strong>Total size:</strong> {{ results['total_size'] }} MB</p>
-        <p><strong>Total time:</strong> {{ results['total_time'] }}</p>
-        <ul>
-            {% for video in results['video_details'] %}
-            <li>
-                URL: {{ video['url'] }}<br>
-                Size: {{ video['formatted_size'] }}<br>
-                Time: {{ video['formatted_time'] }}
-            </li>
-            {% endfor %}
-        </ul>
-        <a href="/">Upload another file</a>
-        """, results=results)
-
-    except json.JSONDecodeError:
+        results = process_urls(urls, accurate=accurate)
+
+        # Stream the results page so rows are sent as they are rendered,
+        # batching template events so each write carries many rows
+        stream = RESULTS_TEMPLATE.stream(results=results)
+        stream.enable_buffering(100)
+        return Response(stream_with_context(stream), mimetype="text/html")
+
+    except (msgspec.DecodeError, ijson.JSONError):
         return jsonify({"error": "Invalid JSON file."}), 400
 
 # Run the Flask app
@@ -0,0 +1,202 @@
+import io
+import os
+import signal
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from markupsafe import Markup
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "API"))
+
+import index
+
+DOCUMENT = b"""[
+    {"titleUrl": "https://www.youtube.com/watch?v=a", "title": "Watched https://x.com/"},
+    "https://www.youtube.com/watch?v=b",
+    {"nested": [{"url": "http://youtu.be/c"}, "not a url", 3]}
+]"""
+
+
+class Handler(BaseHTTPRequestHandler):
+    # path -> (status, headers)
+    routes = {
+        "/ok": (200, {"Content-Length": "2048"}),
+        "/429": (429, {"Content-Length": "5000"}),
+        "/huge": (200, {"Content-Length": "18446744073709551615"}),
+        "/redirect": (302, {"Location": "/ok", "Content-Length": "0"}),
+        "/redirect-twice": (302, {"Location": "/redirect", "Content-Length": "0"}),
+    }
+
+    def do_HEAD(self):
+        status, headers = self.routes[self.path]
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+
+    def do_GET(self):
+        if self.path == "/truncated":
+            # Promise more body than is sent, then hang up
+            self.send_response(200)
+            self.send_header("Content-Length", "100")
+            self.end_headers()
+            self.wfile.write(b"x" * 10)
+            return
+        self.send_response(200)
+        self.send_header("Content-Length", "2048")
+        self.end_headers()
+        self.wfile.write(b"x" * 2048)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture(scope="module")
+def server():
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{httpd.server_port}"
+    httpd.shutdown()
+
+
+@pytest.fixture(autouse=True)
+def head_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(index, "HEAD_CACHE_PATH", str(tmp_path / "head_cache.sqlite"), raising=False)
+
+
+def cached_urls():
+    with index.closing(index.open_head_cache()) as conn:
+        return [url for url, in conn.execute("SELECT url FROM head_cache")]
+
+
+def upload(client, body):
+    return client.post("/upload", data={"file": (io.BytesIO(body), "history.json")})
+
+
+def test_stream_and_decoded_parse_paths_agree():
+    streamed = index.stream_urls(io.BytesIO(DOCUMENT))
+    decoded = index.parse_upload(DOCUMENT)
+    assert streamed == decoded == [
+        "https://www.youtube.com/watch?v=a",
+        "https://www.youtube.com/watch?v=b",
+        "http://youtu.be/c",
+    ]
+
+
+def test_upload_rejects_nan_on_both_parse_paths(monkeypatch):
+    client = index.app.test_client()
+    for threshold in (0, index.STREAM_THRESHOLD):
+        monkeypatch.setattr(index, "STREAM_THRESHOLD", threshold)
+        response = upload(client, b"[NaN]")
+        assert response.status_code == 400
+        assert response.get_json() == {"error": "Invalid JSON file."}
+
+
+def test_getaddrinfo_is_cached_until_ttl(monkeypatch):
+    calls = []
+
+    def fake_getaddrinfo(*args, **kwargs):
+        calls.append(args)
+        return [("resolved", args)]
+
+    monkeypatch.setattr(index, "system_getaddrinfo", fake_getaddrinfo)
+    monkeypatch.setattr(index, "DNS_CACHE", {})
+    assert index.socket.getaddrinfo("example.test", 443) == [("resolved", ("example.test", 443))]
+    index.socket.getaddrinfo("example.test", 443)
+    assert len(calls) == 1
+
+    monkeypatch.setattr(index, "DNS_CACHE_TTL", -1)
+    index.DNS_CACHE.clear()
+    index.socket.getaddrinfo("example.test", 443)
+    index.socket.getaddrinfo("example.test", 443)
+    assert len(calls) == 3
+
+
+def test_process_urls_requests_duplicates_once_and_weights_totals(monkeypatch):
+    requested = []
+
+    async def fake_head_all(urls, *args, **kwargs):
+        requested.extend(urls)
+        return [(url, 1024 * 1024, 0.0) for url in urls]
+
+    monkeypatch.setattr(index, "head_all", fake_head_all)
+    urls = ["https://a.com/", "https://b.com/", "https://a.com/", "https://a.com/"]
+    results = index.process_urls(urls)
+    assert requested == ["https://a.com/", "https://b.com/"]
+    assert results["total_urls"] == 4
+    assert results["total_size"] == 4
+
+
+def test_head_all_cached_keeps_upload_order(monkeypatch):
+    async def fake_head_all(urls, *args, **kwargs):
+        return [(url, 1, 0.5) for url in urls]
+
+    monkeypatch.setattr(index, "head_all", fake_head_all)
+    index.head_all_cached(["https://b.com/"])
+    urls = ["https://a.com/", "https://b.com/"]
+    assert [row[0] for row in index.head_all_cached(urls)] == urls
+
+
+def test_head_all_cached_stores_only_successful_sizes(server):
+    ok, throttled, huge = server + "/ok", server + "/429", server + "/huge"
+    sizes = [size for _, size, _ in index.head_all_cached([ok, throttled, huge])]
+    assert sizes == [2048, 0, 0]
+    assert cached_urls() == [ok]
+
+
+def test_download_request_reports_body_size(server):
+    url = server + "/ok"
+    assert index.download_request(url, index.SESSION)[:2] == (url, 2048)
+
+
+def test_download_request_counts_truncated_body_as_failure(server):
+    url = server + "/truncated"
+    assert index.download_request(url, index.SESSION) == (url, 0, 0)
+
+
+def test_run_head_all_counts_invalid_url_as_failure():
+    url = "https://example.com/a\tb"
+    assert index.run_head_all([url]) == [(url, None, 0.0)]
+
+
+def test_run_head_all_reuses_client_across_calls(server):
+    index.run_head_all([server + "/ok"])
+    client = index.HEAD_CLIENT
+    index.run_head_all([server + "/ok"])
+    assert index.HEAD_CLIENT is client
+
+
+def test_oversized_upload_is_rejected_with_json_413(monkeypatch):
+    monkeypatch.setitem(index.app.config, "MAX_CONTENT_LENGTH", 100)
+    response = upload(index.app.test_client(), b"[" + b" " * 200 + b"]")
+    assert response.status_code == 413
+    assert response.get_json() == {"error": "File too large."}
+
+
+def test_head_request_follows_a_single_redirect(server):
+    once, twice = server + "/redirect", server + "/redirect-twice"
+    assert index.run_head_all([once, twice]) == [(once, 2048, 0.0), (twice, None, 0.0)]
+
+
+def test_parse_upload_recovers_from_a_dead_worker(monkeypatch):
+    pool = index.ProcessPoolExecutor(1)
+    os.kill(pool.submit(os.getpid).result(), signal.SIGKILL)
+    monkeypatch.setattr(index, "PARSE_WORKERS", 1)
+    monkeypatch.setattr(index, "PARSE_POOL", pool)
+    assert index.parse_upload(DOCUMENT) == index.stream_urls(io.BytesIO(DOCUMENT))
+    assert index.PARSE_POOL is not pool
+    assert index.parse_upload(DOCUMENT) == index.stream_urls(io.BytesIO(DOCUMENT))
+    index.PARSE_POOL.shutdown()
+
+
+def test_jsonify_output_shape():
+    with index.app.test_request_context():
+        response = index.jsonify({"b": 1, "a": Markup("<i>x</i>")})
+    assert response.mimetype == "application/json"
+    assert response.get_data() == b'{"a":"<i>x</i>","b":1}\n'
+
+    response = index.app.test_client().post("/upload", data={})
+    assert response.status_code == 400
+    assert response.get_json() == {"error": "No file part"}